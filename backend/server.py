@@ -1,10 +1,21 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, status
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import OperationFailure, PyMongoError
 import os
+import sys
+import json
+import time
+import random
+import asyncio
 import logging
+import threading
+import gzip
 from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List, Optional
@@ -14,6 +25,11 @@ import jwt
 import bcrypt
 from bson import ObjectId
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
@@ -35,6 +51,31 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 security = HTTPBearer()
 
+# Profiling Configuration
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL_MS', '5')) / 1000
+PROFILE_DIR = Path(os.environ.get('PROFILE_DIR', ROOT_DIR / 'profiles'))
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', '100'))
+# Caps a single profile, e.g. 6000 samples is 30s at the default interval.
+PROFILE_MAX_SAMPLES = int(os.environ.get('PROFILE_MAX_SAMPLES', '6000'))
+# Long-lived streams are only profiled on explicit request.
+PROFILE_UNSAMPLED_PATHS = {"/api/products/stream"}
+PROFILE_HEADER = b"x-profile-token"
+
+# Product stream Configuration
+STREAM_QUEUE_SIZE = 100
+STREAM_HEARTBEAT_SECONDS = 15
+# ChangeStreamFatalError and ChangeStreamHistoryLost: the resume token is unusable.
+NON_RESUMABLE_CHANGE_STREAM_CODES = {280, 286}
+
+# Compression Configuration
+GZIP_MINIMUM_SIZE = 1000
+# Without a change stream, external catalog writes go unseen, so snapshots expire.
+SNAPSHOT_MAX_AGE_SECONDS = 60
+# Snapshots are rebuilt on every catalog change, so favour fast compression.
+SNAPSHOT_GZIP_LEVEL = 6
+SNAPSHOT_BROTLI_QUALITY = 5
+
 # Pydantic Models
 class User(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -117,6 +158,404 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         raise HTTPException(status_code=401, detail="User not found")
     return User(**user)
 
+# Request profiling
+class StackSampler:
+    """Samples the stack of one asyncio task from a background thread.
+
+    While the task is running, the event loop thread's real stack is recorded,
+    so Pydantic validation and serialization show up. While it is suspended,
+    the coroutine await chain is recorded instead, ending in an "[await]"
+    frame, so time spent waiting on Mongo is attributed to its call site.
+    Samples are aggregated into folded stacks for flamegraph.pl/speedscope,
+    and sampling ends on its own after max_samples.
+    """
+
+    def __init__(self, task: asyncio.Task, interval: float, max_samples: int = PROFILE_MAX_SAMPLES):
+        self.task = task
+        self.interval = interval
+        self.max_samples = max_samples
+        self.samples = 0
+        self.thread_id = threading.get_ident()
+        self.stacks = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        # Never blocks: no sample is recorded once this is set.
+        self._stop.set()
+
+    def join(self):
+        self._thread.join()
+
+    def _run(self):
+        while self.samples < self.max_samples and not self._stop.wait(self.interval):
+            stack = self._sample()
+            if stack and not self._stop.is_set():
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.samples += 1
+
+    def _sample(self) -> Optional[str]:
+        root = self.task.get_coro().cr_frame
+        if root is None:
+            return None
+        frames = []
+        frame = sys._current_frames().get(self.thread_id)
+        while frame is not None:
+            frames.append(frame)
+            if frame is root:
+                return ";".join(_frame_label(f) for f in reversed(frames))
+            frame = frame.f_back
+        # The task is suspended: walk its await chain from the outside in.
+        labels = []
+        coro = self.task.get_coro()
+        while coro is not None and getattr(coro, "cr_frame", None) is not None:
+            labels.append(_frame_label(coro.cr_frame))
+            coro = coro.cr_await
+        labels.append("[await]")
+        return ";".join(labels)
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def _has_profile_token(scope) -> bool:
+    for name, value in scope.get("headers", []):
+        if name == PROFILE_HEADER:
+            try:
+                payload = jwt.decode(
+                    value.decode("latin-1"), SECRET_KEY, algorithms=[ALGORITHM], options={"require": ["exp"]}
+                )
+            except jwt.PyJWTError:
+                return False
+            return payload.get("scope") == "profile"
+    return False
+
+def write_profile(name: str, folded: str):
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    (PROFILE_DIR / name).write_text(folded)
+    profiles = sorted(PROFILE_DIR.glob("*.folded"), key=lambda p: p.stat().st_mtime)
+    for old in profiles[:-PROFILE_MAX_FILES]:
+        # A concurrent write may already have removed it.
+        old.unlink(missing_ok=True)
+
+class ProfilingMiddleware:
+    """Captures a sampled profile for requests carrying a signed
+    X-Profile-Token header, or for a PROFILE_SAMPLE_RATE share of traffic.
+
+    Tokens are JWTs signed with SECRET_KEY whose "scope" claim is "profile"
+    and which carry an "exp" claim. Paths in PROFILE_UNSAMPLED_PATHS are only
+    profiled with a token. Profiles are written as folded stacks to
+    PROFILE_DIR, keeping the newest PROFILE_MAX_FILES files.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not (
+            (
+                PROFILE_SAMPLE_RATE
+                and scope["path"] not in PROFILE_UNSAMPLED_PATHS
+                and random.random() < PROFILE_SAMPLE_RATE
+            )
+            or _has_profile_token(scope)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = uuid.uuid4().hex
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())]
+            await send(message)
+
+        sampler = StackSampler(asyncio.current_task(), PROFILE_INTERVAL)
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            sampler.stop()
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, sampler.join)
+            path = "".join(c if c.isalnum() else "_" for c in scope["path"].strip("/")) or "root"
+            name = f"{int(time.time() * 1000)}-{scope['method']}-{path}-{profile_id}.folded"
+            try:
+                await loop.run_in_executor(None, write_profile, name, sampler.folded())
+            except OSError:
+                logger.exception("Failed to write profile %s", name)
+
+# Product change stream
+class ProductSubscriber:
+    def __init__(self, category: Optional[str], ids: Optional[set]):
+        self.category = category
+        self.ids = ids
+        self.queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+    def wants(self, event: dict) -> bool:
+        if self.category and event["category"] != self.category:
+            return False
+        if self.ids and event["id"] not in self.ids:
+            return False
+        return True
+
+    def offer(self, message: bytes):
+        # A slow client loses its oldest pending events rather than
+        # holding up the fan-out to everyone else.
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(message)
+
+class ProductEventHub:
+    """Fans product changes out to SSE subscribers.
+
+    A single MongoDB change stream feeds every subscriber. When change
+    streams are unavailable (e.g. a standalone mongod) or not permitted,
+    writers in this process call publish() directly instead. Delete events
+    carry the removed product only when pre-images are enabled on the
+    collection (changeStreamPreAndPostImages, MongoDB 6.0+ and PyMongo
+    4.2+); otherwise a deletion just invalidates the catalog snapshots.
+    Servers or drivers that reject pre-images are watched without them.
+    """
+
+    def __init__(self):
+        self.subscribers = set()
+        self.watching = False
+        self.pre_images = True
+        self._task = None
+
+    def subscribe(self, category: Optional[str] = None, ids: Optional[set] = None) -> ProductSubscriber:
+        subscriber = ProductSubscriber(category, ids)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: ProductSubscriber):
+        self.subscribers.discard(subscriber)
+
+    def publish(self, product: dict, op: str = "update"):
+        invalidate_catalog_snapshots()
+        if product.get("id") is None:
+            return
+        event = {
+            "op": op,
+            "id": product["id"],
+            "category": product.get("category"),
+            "price": product.get("price"),
+            "stock": product.get("stock"),
+        }
+        message = f"event: product\ndata: {json.dumps(event, default=str)}\n\n".encode()
+        for subscriber in list(self.subscribers):
+            if subscriber.wants(event):
+                subscriber.offer(message)
+
+    def publish_local(self, product: dict, op: str = "update"):
+        # With a live change stream the write will arrive from MongoDB.
+        if not self.watching:
+            self.publish(product, op)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._watch())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def _handle(self, change: dict):
+        op = change["operationType"]
+        product = change.get("fullDocumentBeforeChange" if op == "delete" else "fullDocument")
+        if product:
+            self.publish(product, op)
+        else:
+            # e.g. an update whose document was deleted before the lookup;
+            # the delete itself arrives as its own change.
+            invalidate_catalog_snapshots()
+
+    def _disable_pre_images(self, error: Exception) -> bool:
+        # MongoDB < 6.0 rejects the unknown field (IDLUnknownField); PyMongo
+        # < 4.2 rejects the keyword argument.
+        message = str(error)
+        if not self.pre_images or ("fullDocumentBeforeChange" not in message and "full_document_before_change" not in message):
+            return False
+        logger.info("Change stream pre-images unsupported, deletions will not be streamed: %s", error)
+        self.pre_images = False
+        return True
+
+    async def _watch(self):
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+        resume_token = None
+        failures = 0
+        while True:
+            try:
+                options = {"full_document": "updateLookup", "resume_after": resume_token}
+                if self.pre_images:
+                    options["full_document_before_change"] = "whenAvailable"
+                async with db.products.watch(pipeline, **options) as stream:
+                    self.watching = True
+                    failures = 0
+                    if resume_token is None:
+                        # Changes made while no stream was open were missed.
+                        invalidate_catalog_snapshots()
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        failures = 0
+                        try:
+                            self._handle(change)
+                        except Exception:
+                            logger.exception("Failed to publish product change %s", change.get("_id"))
+            except OperationFailure as e:
+                if self._disable_pre_images(e):
+                    continue
+                if e.code == 40573:
+                    logger.info("Change streams unavailable, using in-process product events")
+                    return
+                if e.code in (13, 18):
+                    logger.error("Not authorized to watch products, using in-process product events: %s", e)
+                    return
+                if e.code in NON_RESUMABLE_CHANGE_STREAM_CODES or not e.has_error_label("ResumableChangeStreamError"):
+                    resume_token = None
+                logger.warning("Product change stream failed: %s", e)
+            except PyMongoError as e:
+                logger.warning("Product change stream interrupted: %s", e)
+            except TypeError as e:
+                if self._disable_pre_images(e):
+                    continue
+                logger.exception("Product change stream crashed")
+            except Exception:
+                logger.exception("Product change stream crashed")
+            finally:
+                self.watching = False
+            failures += 1
+            await asyncio.sleep(min(2 ** failures, 60))
+
+product_events = ProductEventHub()
+
+async def product_event_stream(request: Request, subscriber: ProductSubscriber, heartbeat: float = STREAM_HEARTBEAT_SECONDS):
+    try:
+        yield b"retry: 5000\n\n"
+        while not await request.is_disconnected():
+            try:
+                yield await asyncio.wait_for(subscriber.queue.get(), heartbeat)
+            except asyncio.TimeoutError:
+                yield b": keep-alive\n\n"
+    finally:
+        product_events.unsubscribe(subscriber)
+
+# Catalog snapshots
+def _compress(body: bytes) -> dict:
+    bodies = {"identity": body, "gzip": gzip.compress(body, compresslevel=SNAPSHOT_GZIP_LEVEL)}
+    if brotli is not None:
+        bodies["br"] = brotli.compress(body, quality=SNAPSHOT_BROTLI_QUALITY)
+    return bodies
+
+def negotiate_encoding(accept_encoding: str, available) -> str:
+    """Picks the available coding with the highest q-value, preferring
+    br, then gzip, then identity on ties."""
+    weights = {}
+    for part in accept_encoding.split(","):
+        coding, *params = part.strip().split(";")
+        weight = 1.0
+        for param in params:
+            name, _, value = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        if coding.strip():
+            weights[coding.strip().lower()] = weight
+    wildcard = weights.get("*")
+    # An unlisted identity stays acceptable but loses to any listed coding.
+    best, best_weight = "identity", weights.get("identity", 0.001 if wildcard is None else wildcard)
+    for coding in ("gzip", "br"):
+        weight = weights.get(coding, wildcard or 0.0)
+        if coding in available and weight > 0 and weight >= best_weight:
+            best, best_weight = coding, weight
+    return best
+
+class CatalogSnapshot:
+    """Serialized and precompressed bytes of an unfiltered catalog response.
+
+    After the catalog changes, one background task rebuilds the snapshot
+    while requests keep getting the previous bodies. The uncompressed body
+    is published as soon as it is serialized, and the compressed variants
+    follow. Only the very first build is waited for.
+    """
+
+    def __init__(self, load):
+        self.load = load
+        self.bodies = None
+        self.built_at = 0.0
+        self.version = 0
+        self.built_version = -1
+        self._build = None
+
+    def invalidate(self):
+        self.version += 1
+
+    def _stale(self) -> bool:
+        if self.built_version != self.version:
+            return True
+        return not product_events.watching and time.time() - self.built_at > SNAPSHOT_MAX_AGE_SECONDS
+
+    def _rebuild(self) -> asyncio.Task:
+        if self._build is None:
+            self._build = asyncio.get_running_loop().create_task(self._run_build())
+            # Failures are logged in _run_build; don't warn about unread results.
+            self._build.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return self._build
+
+    async def _run_build(self):
+        try:
+            version = self.version
+            body = JSONResponse(content=jsonable_encoder(await self.load())).body
+            self.bodies = {"identity": body}
+            self.built_version, self.built_at = version, time.time()
+            self.bodies = await asyncio.get_running_loop().run_in_executor(None, _compress, body)
+        except Exception:
+            logger.exception("Failed to build catalog snapshot")
+            raise
+        finally:
+            self._build = None
+
+    async def get(self) -> dict:
+        if self._stale():
+            build = self._rebuild()
+            if self.bodies is None:
+                await asyncio.shield(build)
+        return self.bodies
+
+    async def response(self, request: Request) -> Response:
+        bodies = await self.get()
+        encoding = negotiate_encoding(request.headers.get("accept-encoding", ""), bodies)
+        headers = {"Vary": "Accept-Encoding"}
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(bodies[encoding], media_type="application/json", headers=headers)
+
+async def load_products():
+    products = await db.products.find().to_list(1000)
+    return [Product(**product) for product in products]
+
+async def load_categories():
+    return {"categories": await db.products.distinct("category")}
+
+products_snapshot = CatalogSnapshot(load_products)
+categories_snapshot = CatalogSnapshot(load_categories)
+
+def invalidate_catalog_snapshots():
+    products_snapshot.invalidate()
+    categories_snapshot.invalidate()
+
 # Initialize sample products
 async def init_products():
     existing = await db.products.find_one()
@@ -143,6 +582,7 @@ async def init_products():
     
     for product in products:
         await db.products.insert_one(product.dict())
+        product_events.publish_local(product.dict(), "insert")
 
 # Authentication routes
 @api_router.post("/register", response_model=UserResponse)
@@ -171,7 +611,9 @@ async def get_me(current_user: User = Depends(get_current_user)):
 
 # Product routes
 @api_router.get("/products", response_model=List[Product])
-async def get_products(search: Optional[str] = None, category: Optional[str] = None):
+async def get_products(request: Request, search: Optional[str] = None, category: Optional[str] = None):
+    if not search and not category:
+        return await products_snapshot.response(request)
     query = {}
     if search:
         query["$or"] = [
@@ -184,6 +626,17 @@ async def get_products(search: Optional[str] = None, category: Optional[str] = N
     products = await db.products.find(query).to_list(1000)
     return [Product(**product) for product in products]
 
+@api_router.get("/products/stream")
+async def stream_products(request: Request, category: Optional[str] = None, ids: Optional[str] = None):
+    product_ids = {i for i in ids.split(",") if i} if ids else None
+    subscriber = product_events.subscribe(category, product_ids)
+
+    return StreamingResponse(
+        product_event_stream(request, subscriber),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @api_router.get("/products/{product_id}", response_model=Product)
 async def get_product(product_id: str):
     product = await db.products.find_one({"id": product_id})
@@ -192,9 +645,8 @@ async def get_product(product_id: str):
     return Product(**product)
 
 @api_router.get("/categories")
-async def get_categories():
-    categories = await db.products.distinct("category")
-    return {"categories": categories}
+async def get_categories(request: Request):
+    return await categories_snapshot.response(request)
 
 # Cart routes
 @api_router.post("/cart", response_model=CartItemResponse)
@@ -267,11 +719,16 @@ async def clear_cart(current_user: User = Depends(get_current_user)):
 # Initialize products on startup
 @app.on_event("startup")
 async def startup_event():
+    product_events.start()
     await init_products()
 
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)
+
+app.add_middleware(ProfilingMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -289,4 +746,5 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await product_events.stop()
     client.close()
\ No newline at end of file
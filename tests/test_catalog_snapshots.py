@@ -0,0 +1,127 @@
+import asyncio
+import gzip
+import json
+
+import pytest
+from starlette.requests import Request
+
+import server
+
+BOTH = {"identity": b"", "gzip": b"", "br": b""}
+GZIP_ONLY = {"identity": b"", "gzip": b""}
+
+
+@pytest.mark.parametrize("accept_encoding, available, expected", [
+    ("", BOTH, "identity"),
+    ("gzip, deflate, br", BOTH, "br"),
+    ("gzip, deflate, br", GZIP_ONLY, "gzip"),
+    ("br;q=0.1, gzip;q=1.0", BOTH, "gzip"),
+    ("br;q=1.0, gzip;q=0.5", BOTH, "br"),
+    ("GZIP;q=0.5", BOTH, "gzip"),
+    ("br;q=0", BOTH, "identity"),
+    ("gzip;q=0, *", BOTH, "br"),
+    ("gzip;q=0, *", GZIP_ONLY, "identity"),
+    ("*", BOTH, "br"),
+    ("identity, gzip;q=0.5", BOTH, "identity"),
+    ("gzip;q=bogus", BOTH, "identity"),
+])
+def test_negotiate_encoding(accept_encoding, available, expected):
+    assert server.negotiate_encoding(accept_encoding, available) == expected
+
+
+def make_request(accept_encoding):
+    return Request({"type": "http", "headers": [(b"accept-encoding", accept_encoding.encode())]})
+
+
+def counting_loader(catalog):
+    loads = []
+
+    async def load():
+        loads.append(1)
+        await asyncio.sleep(0)
+        return dict(catalog)
+
+    return load, loads
+
+
+def test_first_build_is_shared_by_concurrent_requests():
+    load, loads = counting_loader({"categories": ["audio"]})
+
+    async def main():
+        snapshot = server.CatalogSnapshot(load)
+        return await asyncio.gather(*(snapshot.get() for _ in range(8)))
+
+    results = asyncio.run(main())
+    assert len(loads) == 1
+    assert all(bodies is results[0] for bodies in results)
+    assert set(results[0]) >= {"identity", "gzip"}
+
+
+def test_invalidate_serves_previous_bodies_while_rebuilding():
+    catalog = {"categories": ["audio"]}
+    load, loads = counting_loader(catalog)
+
+    async def main():
+        snapshot = server.CatalogSnapshot(load)
+        first = await snapshot.get()
+        assert await snapshot.get() is first
+        catalog["categories"] = ["audio", "laptops"]
+        snapshot.invalidate()
+        stale = await asyncio.gather(*(snapshot.get() for _ in range(8)))
+        assert all(bodies is first for bodies in stale)
+        await snapshot._build
+        return await snapshot.response(make_request("gzip"))
+
+    response = asyncio.run(main())
+    assert len(loads) == 2
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert json.loads(gzip.decompress(response.body)) == {"categories": ["audio", "laptops"]}
+
+
+def test_changes_during_a_build_do_not_start_more_builds():
+    load, loads = counting_loader({"categories": []})
+
+    async def main():
+        snapshot = server.CatalogSnapshot(load)
+        await snapshot.get()
+        snapshot.invalidate()
+        await snapshot.get()
+        build = snapshot._build
+        await asyncio.sleep(0)  # let the build read the version it serializes
+        for _ in range(5):
+            snapshot.invalidate()
+            await snapshot.get()
+            assert snapshot._build is build
+        await build
+        assert snapshot._stale()
+        await snapshot.get()
+        await snapshot._build
+        assert not snapshot._stale()
+
+    asyncio.run(main())
+    assert len(loads) == 3
+
+
+def test_snapshot_expires_without_change_stream(monkeypatch):
+    load, loads = counting_loader({"categories": []})
+
+    async def main():
+        snapshot = server.CatalogSnapshot(load)
+        await snapshot.get()
+        snapshot.built_at -= server.SNAPSHOT_MAX_AGE_SECONDS + 1
+        await snapshot.get()
+        await snapshot._build
+
+    monkeypatch.setattr(server.product_events, "watching", False)
+    asyncio.run(main())
+    assert len(loads) == 2
+
+
+def test_identity_response_has_no_content_encoding():
+    async def load():
+        return {"categories": ["audio"]}
+
+    response = asyncio.run(server.CatalogSnapshot(load).response(make_request("")))
+    assert "content-encoding" not in response.headers
+    assert json.loads(response.body) == {"categories": ["audio"]}
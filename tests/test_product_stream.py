@@ -0,0 +1,185 @@
+import asyncio
+import json
+
+from bson.decimal128 import Decimal128
+from pymongo.errors import AutoReconnect, OperationFailure
+
+import server
+
+
+class FakeRequest:
+    def __init__(self, disconnect_after):
+        self.checks = 0
+        self.disconnect_after = disconnect_after
+
+    async def is_disconnected(self):
+        self.checks += 1
+        return self.checks > self.disconnect_after
+
+
+def product(**fields):
+    doc = {"id": "p1", "category": "audio", "price": 10.0, "stock": 3}
+    doc.update(fields)
+    return doc
+
+
+def test_subscriber_filters_by_category_and_ids():
+    event = {"id": "p1", "category": "audio"}
+    assert server.ProductSubscriber(None, None).wants(event)
+    assert server.ProductSubscriber("audio", None).wants(event)
+    assert not server.ProductSubscriber("laptops", None).wants(event)
+    assert server.ProductSubscriber(None, {"p1", "p2"}).wants(event)
+    assert not server.ProductSubscriber(None, {"p2"}).wants(event)
+
+
+def test_offer_drops_oldest_when_full(monkeypatch):
+    monkeypatch.setattr(server, "STREAM_QUEUE_SIZE", 2)
+    subscriber = server.ProductSubscriber(None, None)
+    for message in (b"1", b"2", b"3"):
+        subscriber.offer(message)
+    assert [subscriber.queue.get_nowait() for _ in range(2)] == [b"2", b"3"]
+
+
+def test_publish_frames_events_and_tolerates_bad_documents():
+    hub = server.ProductEventHub()
+    subscriber = hub.subscribe(category="audio")
+    hub.publish(product(price=Decimal128("9.99")))
+    hub.publish({"category": "audio"})
+    hub.publish(product(id="p2", category="laptops"))
+    hub.publish({"id": "p3", "category": "audio"}, "delete")
+
+    first = subscriber.queue.get_nowait().decode()
+    assert first.startswith("event: product\ndata: ") and first.endswith("\n\n")
+    assert json.loads(first.split("data: ", 1)[1]) == {
+        "op": "update", "id": "p1", "category": "audio", "price": "9.99", "stock": 3,
+    }
+    last = json.loads(subscriber.queue.get_nowait().decode().split("data: ", 1)[1])
+    assert last == {"op": "delete", "id": "p3", "category": "audio", "price": None, "stock": None}
+    assert subscriber.queue.empty()
+
+
+def test_event_stream_sends_events_and_heartbeats():
+    async def main():
+        hub = server.ProductEventHub()
+        subscriber = hub.subscribe()
+        subscriber.offer(b"event: product\ndata: {}\n\n")
+        chunks = []
+        async for chunk in server.product_event_stream(FakeRequest(2), subscriber, heartbeat=0.01):
+            chunks.append(chunk)
+        return chunks
+
+    assert asyncio.run(main()) == [b"retry: 5000\n\n", b"event: product\ndata: {}\n\n", b": keep-alive\n\n"]
+
+
+class FakeStream:
+    def __init__(self, changes, error):
+        self.changes = changes
+        self.error = error
+        self.resume_token = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.changes:
+            self.resume_token = {"_data": len(self.changes)}
+            return self.changes.pop(0)
+        raise self.error
+
+
+class FakeProducts:
+    def __init__(self, streams):
+        self.streams = streams
+        self.resume_after = []
+        self.options = []
+
+    def watch(self, pipeline, resume_after=None, **kwargs):
+        self.resume_after.append(resume_after)
+        self.options.append(kwargs)
+        stream = self.streams.pop(0)
+        if isinstance(stream, Exception):
+            raise stream
+        return stream
+
+
+class FakeDb:
+    def __init__(self, streams):
+        self.products = FakeProducts(streams)
+
+
+def test_watch_survives_bad_changes_and_drops_lost_resume_token(monkeypatch):
+    fake_db = FakeDb([
+        FakeStream(
+            [{"_id": 0}, {"_id": 1, "operationType": "update"}, {"_id": 2, "operationType": "insert", "fullDocument": product()}],
+            OperationFailure("history lost", code=286),
+        ),
+        FakeStream([], RuntimeError("boom")),
+        FakeStream([], OperationFailure("unauthorized", code=13)),
+    ])
+    monkeypatch.setattr(server, "db", fake_db)
+
+    async def no_sleep(delay):
+        pass
+
+    async def main():
+        hub = server.ProductEventHub()
+        subscriber = hub.subscribe()
+        monkeypatch.setattr(asyncio, "sleep", no_sleep)
+        await hub._watch()
+        return hub, subscriber
+
+    hub, subscriber = asyncio.run(main())
+    assert not hub.watching
+    assert subscriber.queue.qsize() == 1
+    assert fake_db.products.resume_after == [None, None, None]
+
+
+def run_watch(monkeypatch, streams):
+    fake_db = FakeDb(streams)
+    monkeypatch.setattr(server, "db", fake_db)
+    delays = []
+
+    async def record_sleep(delay):
+        delays.append(delay)
+
+    async def main():
+        hub = server.ProductEventHub()
+        monkeypatch.setattr(asyncio, "sleep", record_sleep)
+        await hub._watch()
+        return hub
+
+    hub = asyncio.run(main())
+    return hub, fake_db.products.options, delays
+
+
+UNAUTHORIZED = OperationFailure("unauthorized", code=13)
+
+
+def test_watch_retries_without_pre_images_on_old_server(monkeypatch):
+    rejected = OperationFailure(
+        "BSON field '$changeStream.fullDocumentBeforeChange' is an unknown field.", code=40415
+    )
+    hub, options, delays = run_watch(monkeypatch, [FakeStream([], rejected), FakeStream([], UNAUTHORIZED)])
+    assert not hub.pre_images
+    assert "full_document_before_change" in options[0]
+    assert "full_document_before_change" not in options[1]
+    assert delays == []
+
+
+def test_watch_retries_without_pre_images_on_old_driver(monkeypatch):
+    rejected = TypeError("watch() got an unexpected keyword argument 'full_document_before_change'")
+    hub, options, delays = run_watch(monkeypatch, [rejected, FakeStream([], UNAUTHORIZED)])
+    assert not hub.pre_images
+    assert "full_document_before_change" not in options[1]
+
+
+def test_watch_backoff_resets_once_a_stream_opens(monkeypatch):
+    dropped = [FakeStream([], AutoReconnect("election")) for _ in range(4)]
+    hub, options, delays = run_watch(monkeypatch, dropped + [FakeStream([], UNAUTHORIZED)])
+    assert delays == [2, 2, 2, 2]
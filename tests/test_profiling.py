@@ -0,0 +1,78 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+import jwt
+
+import server
+
+
+def profile_scope(token):
+    return {"type": "http", "headers": [(b"x-profile-token", token.encode())]}
+
+
+def make_token(key=server.SECRET_KEY, **claims):
+    return jwt.encode(claims, key, algorithm=server.ALGORITHM)
+
+
+def test_profile_token_accepted():
+    token = make_token(scope="profile", exp=datetime.utcnow() + timedelta(minutes=5))
+    assert server._has_profile_token(profile_scope(token))
+
+
+def test_profile_token_wrong_scope_rejected():
+    token = make_token(scope="admin", exp=datetime.utcnow() + timedelta(minutes=5))
+    assert not server._has_profile_token(profile_scope(token))
+
+
+def test_profile_token_bad_signature_rejected():
+    token = make_token(key="not-the-secret-key-but-long-enough", scope="profile",
+                       exp=datetime.utcnow() + timedelta(minutes=5))
+    assert not server._has_profile_token(profile_scope(token))
+
+
+def test_profile_token_without_expiry_rejected():
+    assert not server._has_profile_token(profile_scope(make_token(scope="profile")))
+
+
+def test_no_profile_header():
+    assert not server._has_profile_token({"type": "http", "headers": []})
+
+
+def test_write_profile_keeps_newest(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "PROFILE_DIR", tmp_path / "profiles")
+    monkeypatch.setattr(server, "PROFILE_MAX_FILES", 3)
+    for i in range(5):
+        server.write_profile(f"{i}.folded", "main 1\n")
+        os.utime(tmp_path / "profiles" / f"{i}.folded", (i, i))
+    server.write_profile("5.folded", "main 1\n")
+    assert sorted(p.name for p in (tmp_path / "profiles").iterdir()) == ["3.folded", "4.folded", "5.folded"]
+
+
+def test_sampler_records_awaits_without_its_own_frames():
+    async def handler():
+        await asyncio.sleep(0.05)
+
+    async def main():
+        sampler = server.StackSampler(asyncio.current_task(), 0.002)
+        sampler.start()
+        await handler()
+        sampler.stop()
+        await asyncio.get_running_loop().run_in_executor(None, sampler.join)
+        return sampler.folded()
+
+    folded = asyncio.run(main())
+    assert "handler" in folded and "[await]" in folded
+    assert "join" not in folded and "stop" not in folded
+
+
+def test_sampler_stops_at_max_samples():
+    async def main():
+        sampler = server.StackSampler(asyncio.current_task(), 0.001, max_samples=3)
+        sampler.start()
+        await asyncio.sleep(0.05)
+        sampler.stop()
+        sampler.join()
+        return sampler.samples
+
+    assert asyncio.run(main()) == 3